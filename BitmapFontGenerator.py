@@ -1,11 +1,20 @@
 import codecs
+import ctypes
 import struct
 import pathlib
 import argparse
+import math
 import freetype
+import numpy as np
 from PIL import Image
 
 
+# Layout of the description file: a header with the line spacing, followed by
+# one record per glyph.
+HEADER_STRUCT = struct.Struct('<I')
+GLYPH_STRUCT = struct.Struct('<IIIIiiII')
+
+
 def makeFilename(fontFile, fontHeight, encoding):
     fontFilename = fontFile.name
     fontPath = pathlib.Path(fontFilename)
@@ -13,6 +22,15 @@ def makeFilename(fontFile, fontHeight, encoding):
     return f'{fontName}_{fontHeight}_{encoding}'
 
 
+def makeCharacters(encoding):
+    """Return the 256 characters that the numbers from 0 to 255 inclusive encode
+    into with the given encoding, decoded all at once."""
+    characters = codecs.decode(bytes(range(256)), encoding=encoding)
+    if len(characters) != 256:
+        raise ValueError(f'{encoding} is not a single byte encoding')
+    return characters
+
+
 def pathtype(string):
     return pathlib.Path(string)
 
@@ -71,155 +89,200 @@ def getargs():
 
 
 def toPow2(x):
-    p = 2
-    while p < x:
-        p *= 2
-    return p
+    if x <= 2:
+        return 2
+    return 1 << (x - 1).bit_length()
+
+
+def blit(dst, x, y, src):
+    """Copy the src pixel array into the dst one with its top left corner at x,
+    y. Both are indexed by row first."""
+    height, width = src.shape
+    dst[y:y+height, x:x+width] = src
 
 
 class RectanglePacker:
     """Class to help find a more or less optimal packing for various rectangles of
-    various sizes within a square of side power of two."""
+    various sizes within a square of side power of two.
+
+    Rectangles are placed bottom-left first against a skyline: a list of
+    horizontal segments (xmin, xmax, y), xmax excluded, covering the whole side
+    of the square, each one being the lowest free height over its span."""
 
     def __init__(self):
-        self.rectangles = []
-        self.square = {}
+        # Dimensions and packed positions of the rectangles, one row each,
+        # indexed by handler. Only the first self.count rows of self.dims are
+        # used, it grows by doubling.
+        self.dims = np.zeros((16, 2), dtype=np.int32)
+        self.pos = np.zeros((0, 2), dtype=np.int32)
+        self.count = 0
 
     def findNextEmptySpace(self, width, height):
         """Add a rectangle of the given dimensions to the square and return a
         handler."""
-        self.rectangles.append((width, height))
-        return len(self.rectangles) - 1
+        if self.count == len(self.dims):
+            dims = np.zeros((2 * len(self.dims), 2), dtype=np.int32)
+            dims[:self.count] = self.dims
+            self.dims = dims
+
+        self.dims[self.count] = (width, height)
+        self.count += 1
+        return self.count - 1
 
     def pack(self):
         """Run the packing algorithm, each rectangle in the square is packed.
+        The square starts as the smallest power of two that could hold every
+        rectangle's area and is doubled whenever the next rectangle doesn't
+        fit, keeping the rectangles already placed. Rectangles with no area are
+        left out of the packing and placed at (0, 0).
         """
-        self.square.clear()
+        self.pos = np.zeros((self.count, 2), dtype=np.int32)
 
-        sortedRectanglesWithHandler = sorted(
-            ((i, dims) for i, dims in enumerate(self.rectangles)),
-            key=lambda r: r[1][0] * r[1][1],
-            reverse=True
-        )
+        dims = self.dims[:self.count]
+        handlers = np.flatnonzero((dims[:, 0] > 0) & (dims[:, 1] > 0))
+        if handlers.size == 0:
+            return
 
-        for i, rectangle in sortedRectanglesWithHandler:
-            x, y = self._findValidPosition(*rectangle)
-            self.square[i] = (x, y)
+        widths = dims[handlers, 0]
+        heights = dims[handlers, 1]
+
+        # Tallest first, then widest, then in the order they were added
+        sortedHandlers = handlers[np.lexsort((handlers, -widths, -heights))]
+
+        area = int(np.dot(widths.astype(np.int64), heights))
+        widest = int(widths.max())
+        side = toPow2(max(widest, math.isqrt(area)))
+        self._packSkyline(sortedHandlers, side)
 
     def getDim(self):
         """Return the dimensions of the square as a single power of two value.
         """
-        maxx = 0
-        maxy = 0
-
-        for i, xpos, ypos, width, height in self.iterRectangles():
-            xend = xpos + width
-            yend = ypos + height
-
-            if xend > maxx:
-                maxx = xend
-            if yend > maxy:
-                maxy = yend
-
-        if maxx > maxy:
-            return toPow2(maxx)
-        else:
-            return toPow2(maxy)
+        # Rectangles added after the last pack() have no position yet
+        ends = self.pos + self.dims[:len(self.pos)]
+        return toPow2(int(ends.max(initial=0)))
 
     def getPos(self, hdlr):
         """Return the packed position of the rectangle corresponding to the given
         handler.
         """
-        return self.square[hdlr]
-
-    def iterRectangles(self):
-        for i, pos in self.square.items():
-            xpos, ypos = pos
-            wdth, hght = self.rectangles[i]
-            yield (i, xpos, ypos, wdth, hght)
-
-    def _findValidPosition(self, width, height):
-        """Find a valid postion for a rectangle of given dimensions taking into account
-        self.square"""
-        # Find the coordinate of every vertex that isnt the top left corner or
-        # bottom right corner. If no rectangles, only (0, 0).
-
-        coordinates = set()
-
-        for i, xpos, ypos, wdth, hght in self.iterRectangles():
-            pos = (xpos, ypos)
-
-            # Could have been added by its neighbor
-            if pos in coordinates:
-                coordinates.remove(pos)
-
-            tr = (xpos+wdth, ypos)
-            bl = (xpos, ypos+hght)
-            coordinates.add(tr)
-            coordinates.add(bl)
-
-        if not coordinates:
-            coordinates.add((0, 0))
-
-        # Filter out coordinates where the current rectangle wouldn't fit.
-
-        fitting_coordinates = []
-        for x, y in coordinates:
-            if self._fits(x, y, width, height):
-                fitting_coordinates.append((x, y))
-
-        # Take the coordinate closest to the origin
-
-        def distance(coord):
-            x, y = coord
-            xdist = x * x * toPow2(x + width)
-            ydist = y * y * toPow2(y + height)
-            return xdist + ydist
-
-        fitting_coordinates.sort(key=distance)
-        return fitting_coordinates[0]
-
-    def _fits(self, ax, ay, aw, ah):
-        """Return whether a rectangle of dimensions w,h would fit at x,y."""
-
-        # Check for collision with all the already placed rectangles. If it
-        # collides with any of them, it doesn't fit in this position.
-        axmin = ax
-        axmax = ax+aw-1
-        aymin = ay
-        aymax = ay+ah-1
-        for _, bx, by, bw, bh in self.iterRectangles():
-            bxmin = bx
-            bxmax = bx+bw-1
-
-            xcol = axmax >= bxmin and bxmax >= axmin
-            if not xcol:
-                continue
-
-            bymin = by
-            bymax = by+bh-1
-
-            ycol = aymax >= bymin and bymax >= aymin
-            if not ycol:
-                continue
+        return tuple(self.pos[hdlr].tolist())
+
+    def _packSkyline(self, handlers, side):
+        """Place the rectangles of the given handlers, in order, within a square
+        of the given side, doubling it as needed."""
+        skyline = [(0, side, 0)]
+
+        # The skyline is scanned with plain ints, NumPy scalars would make every
+        # comparison and addition there several times slower
+        handlers = handlers.tolist()
+        dims = self.dims[handlers].tolist()
+        positions = []
+
+        for width, height in dims:
+            found = _findSkylinePosition(skyline, side, width, height)
+            while found is None:
+                _growSkyline(skyline, side)
+                side *= 2
+                found = _findSkylinePosition(skyline, side, width, height)
+
+            index, x, y = found
+            positions.append((x, y))
+            _raiseSkyline(skyline, index, x, y + height, width)
+
+        self.pos[handlers] = positions
+
+
+def _findSkylinePosition(skyline, side, width, height):
+    """Find the lowest, then leftmost, position at the start of a skyline segment
+    where a rectangle of the given dimensions fits. Return the segment index and
+    the position, or None if it doesn't fit anywhere."""
+    best = None
+
+    for index, (x, _, y) in enumerate(skyline):
+        end = x + width
+        if end > side:
+            # Segments are sorted by x, the next ones won't fit either
+            break
+
+        # The rectangle rests on the highest segment overlapping its span
+        j = index + 1
+        while j < len(skyline) and skyline[j][0] < end:
+            sy = skyline[j][2]
+            if sy > y:
+                y = sy
+            j += 1
+
+        if y + height > side:
+            continue
+
+        if best is None or y < best[2]:
+            best = (index, x, y)
+
+    return best
+
+
+def _raiseSkyline(skyline, index, x, top, width):
+    """Update the skyline with the top edge of a rectangle placed at the start of
+    the segment at index."""
+    if width == 0:
+        return
+
+    right = x + width
+    j = index
+    rest = []
+    while j < len(skyline) and skyline[j][0] < right:
+        _, sxmax, sy = skyline[j]
+        if sxmax > right:
+            rest.append((right, sxmax, sy))
+        j += 1
+    skyline[index:j] = [(x, right, top)] + rest
+
+    # Merge neighbouring segments at the same height
+    k = max(index - 1, 0)
+    while k < len(skyline) - 1 and k <= index:
+        axmin, _, ay = skyline[k]
+        _, bxmax, by = skyline[k + 1]
+        if ay == by:
+            skyline[k:k + 2] = [(axmin, bxmax, ay)]
+        else:
+            k += 1
 
-            return False
 
-        return True
+def _growSkyline(skyline, side):
+    """Extend the skyline of a square of the given side to one of double the
+    side. What's already placed stays valid, so only the new space to the right
+    is added."""
+    xmin, _, y = skyline[-1]
+    if y == 0:
+        skyline[-1] = (xmin, 2 * side, 0)
+    else:
+        skyline.append((side, 2 * side, 0))
 
 
 def main():
     basedir, faceFile, faceHeight, encoding = getargs()
 
+    # Create the output directories before doing any work, so that this fails
+    # early if they can't be
+    fonts = basedir.joinpath('fonts')
+    fonts.mkdir(exist_ok=True)
+    textures = basedir.joinpath('textures')
+    textures.mkdir(exist_ok=True)
+
     face = freetype.Face(faceFile)
     face.set_pixel_sizes(0, faceHeight)
 
     pack = RectanglePacker()
 
-    linespacing = 0
-    glyphdata = [None]*256
-    for char_number in range(256):
-        char_unicode = codecs.decode(bytes((char_number,)), encoding=encoding)
+    handlers = np.zeros(256, dtype=np.int32)
+    widths = np.zeros(256, dtype=np.int32)
+    heights = np.zeros(256, dtype=np.int32)
+    bearingsX = np.zeros(256, dtype=np.int32)
+    bearingsY = np.zeros(256, dtype=np.int32)
+    advancesX = np.zeros(256, dtype=np.int32)
+    advancesY = np.zeros(256, dtype=np.int32)
+    bitmaps = [None]*256
+    for char_number, char_unicode in enumerate(makeCharacters(encoding)):
         face.load_char(char_unicode)
 
         glyph = face.glyph
@@ -235,57 +298,54 @@ def main():
         width = bitmap.width
         height = bitmap.rows
 
-        spacing = bearingY + (bearingY - height)
-        if spacing > linespacing:
-            linespacing = spacing
+        # Bitmap.buffer builds a list of every pixel, read the raw bytes
+        # instead. Rows are pitch bytes long, which may be more than width.
+        buffer = ctypes.string_at(bitmap._FT_Bitmap.buffer, height*bitmap.pitch)
+        pixels = np.frombuffer(buffer, dtype=np.uint8)
+        pixels = pixels.reshape(height, bitmap.pitch)[:, :width]
 
-        hdlr = pack.findNextEmptySpace(width, height)
+        handlers[char_number] = pack.findNextEmptySpace(width, height)
+        widths[char_number] = width
+        heights[char_number] = height
+        bearingsX[char_number] = bearingX
+        bearingsY[char_number] = bearingY
+        advancesX[char_number] = advanceX
+        advancesY[char_number] = advanceY
+        bitmaps[char_number] = pixels
 
-        glyphdata[char_number] = (
-            hdlr,
-            width, height,
-            bearingX, bearingY,
-            advanceX, advanceY,
-            bitmap.buffer
-        )
+    spacings = bearingsY + (bearingsY - heights)
+    linespacing = max(int(spacings.max()), 0)
 
     filename = makeFilename(faceFile, faceHeight, encoding)
 
     pack.pack()
     dim = pack.getDim()
 
-    im = Image.new('L', (dim, dim))
-    desc = bytes()
+    atlas = np.zeros((dim, dim), dtype=np.uint8)
+    desc = bytearray(HEADER_STRUCT.size + 256*GLYPH_STRUCT.size)
 
-    desc += struct.pack('<I', linespacing)
+    HEADER_STRUCT.pack_into(desc, 0, linespacing)
 
-    for glyph in glyphdata:
-        hdlr, width, height = glyph[:3]
-        offsetX, offsetY = pack.getPos(hdlr)
+    for char_number in range(256):
+        offsetX, offsetY = pack.getPos(handlers[char_number])
 
-        buffer = glyph[-1]
-        for j in range(height):
-            for i in range(width):
-                pixel = buffer[j*width+i]
-                im.putpixel((offsetX+i, offsetY+j), pixel)
+        blit(atlas, offsetX, offsetY, bitmaps[char_number])
 
-        fmt = '<IIIIiiII'
-        data = (
+        GLYPH_STRUCT.pack_into(
+            desc, HEADER_STRUCT.size + char_number*GLYPH_STRUCT.size,
             offsetX, offsetY,
-            width, height,
-            *glyph[3:-1]
+            widths[char_number], heights[char_number],
+            bearingsX[char_number], bearingsY[char_number],
+            advancesX[char_number], advancesY[char_number]
         )
-        desc += struct.pack(fmt, *data)
 
-    fonts = basedir.joinpath('fonts')
-    fonts.mkdir(exist_ok=True)
-    with open(fonts.joinpath(filename + '.ftd'), 'wb') as f:
-        f.write(desc)
+    im = Image.fromarray(atlas)
 
-    textures = basedir.joinpath('textures')
-    textures.mkdir(exist_ok=True)
-    with open(textures.joinpath(filename + '.png'), 'wb') as f:
-        im.save(f)
+    fonts.joinpath(filename + '.ftd').write_bytes(desc)
+
+    # The texture is mostly empty, fast compression barely makes it bigger
+    im.save(textures.joinpath(filename + '.png'),
+            format='PNG', compress_level=1, optimize=False)
 
 
 if __name__ == '__main__':
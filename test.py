@@ -1,7 +1,17 @@
-import struct
-import codecs
+import numpy as np
 from PIL import Image
-from BitmapFontGenerator import makeFilename, getargs
+from BitmapFontGenerator import (
+    makeFilename, makeCharacters, getargs, blit, HEADER_STRUCT
+)
+
+
+# Same layout as BitmapFontGenerator.GLYPH_STRUCT
+GLYPH_DTYPE = np.dtype([
+    ('posX', '<u4'), ('posY', '<u4'),
+    ('wdth', '<u4'), ('hght', '<u4'),
+    ('bearX', '<i4'), ('bearY', '<i4'),
+    ('advX', '<u4'), ('advY', '<u4'),
+])
 
 
 def main():
@@ -16,34 +26,35 @@ def main():
 
     with open(descriptionFilename, 'rb') as f:
         description = f.read()
-    linespacing = struct.unpack('<I', description[:4])[0]
+    linespacing, = HEADER_STRUCT.unpack_from(description)
+    glyphs = np.frombuffer(
+        description, dtype=GLYPH_DTYPE, count=256, offset=HEADER_STRUCT.size)
+
+    with Image.open(textureFilename) as texture:
+        im = np.asarray(texture.convert('L'))
 
-    f = open(textureFilename, 'rb')
-    im = Image.open(f)
+    characterNumbers = {
+        c: i for i, c in enumerate(makeCharacters(encoding))
+    }
 
-    finalIm = Image.new('L', (1000, 1000))
+    finalIm = np.zeros((1000, 1000), dtype=np.uint8)
     position = margin
     for character in text:
         if character == '\n':
             position = (margin[0], position[1]+linespacing)
             continue
 
-        characterNumber = ord(codecs.encode(character, encoding=encoding))
-        glyphInfoStart = 4 + characterNumber*8*4
-        glyphInfo = struct.unpack(
-            '<IIIIiiII', description[glyphInfoStart:glyphInfoStart+4*8])
+        characterNumber = characterNumbers[character]
+        glyphInfo = glyphs[characterNumber]
 
-        posX, posY, wdth, hght, bearX, bearY, advX, advY = glyphInfo
+        # item() gives plain ints, which won't wrap around like uint32 would
+        posX, posY, wdth, hght, bearX, bearY, advX, advY = glyphInfo.item()
 
-        drawPosition = (position[0]+bearX, position[1]-bearY)
-        for j in range(hght):
-            for i in range(wdth):
-                pixel = im.getpixel((posX+i, posY+j))
-                finalIm.putpixel((drawPosition[0]+i, drawPosition[1]+j), pixel)
+        drawX, drawY = (position[0]+bearX, position[1]-bearY)
+        blit(finalIm, drawX, drawY, im[posY:posY+hght, posX:posX+wdth])
         position = (position[0]+advX, position[1]+advY)
 
-    finalIm.show()
-    f.close()
+    Image.fromarray(finalIm).show()
 
 
 if __name__ == '__main__':